@@ -1,6 +1,21 @@
-from typing import Type, Optional, Union, Dict, Any, List, Tuple, ClassVar, TypeVar
+from typing import (
+    Type,
+    Optional,
+    Union,
+    Dict,
+    Any,
+    List,
+    Tuple,
+    ClassVar,
+    TypeVar,
+    Generator,
+    Callable,
+)
+import functools
+import heapq
+import importlib.util
+import math
 import numpy as np
-from collections import deque
 
 from stable_baselines3.ppo import PPO
 from stable_baselines3.common.on_policy_algorithm import OnPolicyAlgorithm
@@ -10,12 +25,15 @@ from stable_baselines3.common.policies import (
     BasePolicy,
     MultiInputActorCriticPolicy,
 )
-from stable_baselines3.common.type_aliases import GymEnv, MaybeCallback, Schedule
-from stable_baselines3.common.utils import (
-    explained_variance,
-    get_schedule_fn,
+from stable_baselines3.common.type_aliases import (
+    GymEnv,
+    MaybeCallback,
+    RolloutBufferSamples,
+    Schedule,
 )
+from stable_baselines3.common.utils import get_schedule_fn
 from stable_baselines3.common.buffers import RolloutBuffer
+from stable_baselines3.common.distributions import DiagGaussianDistribution
 
 from gymnasium import spaces
 
@@ -25,11 +43,317 @@ import warnings
 import torch as th
 from torch.nn import functional as F
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, fall back to numpy
+    njit = None
+
 device = "cuda" if th.cuda.is_available() else "cpu"
 
 SelfPPO = TypeVar("SelfPPO", bound="PPO")
 
 
+def _ppo_loss(
+    log_prob: th.Tensor,
+    old_log_prob: th.Tensor,
+    advantages: th.Tensor,
+    values: th.Tensor,
+    old_values: th.Tensor,
+    returns: th.Tensor,
+    entropy: Optional[th.Tensor],
+    anchor_kl_divs_fn: Optional[Callable[..., th.Tensor]],
+    anchor_kl_inputs: Tuple[th.Tensor, ...],
+    clip_range: th.Tensor,
+    clip_range_vf: Optional[th.Tensor],
+    ent_coef: th.Tensor,
+    vf_coef: th.Tensor,
+    anchor_pol_kl_coef: th.Tensor,
+) -> Tuple[th.Tensor, ...]:
+    """
+    Compute the anchored PPO loss of a minibatch. Only pure tensor ops, so that
+    it can be compiled into a single graph (see ``compile_loss``).
+
+    :param anchor_kl_divs_fn: Per-sample KL div with the anchor policy
+        (``_sampled_kl_divs`` or ``_gaussian_kl_divs``), None when the anchor term is inactive
+    :param anchor_kl_inputs: Arguments of ``anchor_kl_divs_fn``
+    :return: total loss, policy loss, clipped surrogate term of the policy loss,
+        value loss, entropy loss, KL div with the anchor policy, clip fraction
+        and approximate KL div with the old policy (all as 0-dim tensors)
+    """
+    # ratio between old and new policy, should be one at the first iteration
+    log_ratio = log_prob - old_log_prob
+    ratio = th.exp(log_ratio)
+
+    # KL div with anchor
+    if anchor_kl_divs_fn is None:
+        anchor_policy_kl_div = th.zeros((), device=log_prob.device)
+    else:
+        anchor_policy_kl_div = anchor_kl_divs_fn(*anchor_kl_inputs).mean()
+
+    # clipped surrogate loss
+    policy_loss_1 = advantages * ratio
+    policy_loss_2 = advantages * th.clamp(ratio, 1 - clip_range, 1 + clip_range)
+    policy_loss_main_term = -th.min(policy_loss_1, policy_loss_2)
+    policy_loss = (
+        policy_loss_main_term + anchor_pol_kl_coef * anchor_policy_kl_div
+    ).mean()
+
+    if clip_range_vf is None:
+        # No clipping
+        values_pred = values
+    else:
+        # Clip the difference between old and new value
+        # NOTE: this depends on the reward scaling
+        values_pred = old_values + th.clamp(
+            values - old_values, -clip_range_vf, clip_range_vf
+        )
+    # Value loss using the TD(gae_lambda) target
+    value_loss = F.mse_loss(returns, values_pred)
+
+    # Entropy loss favor exploration
+    if entropy is None:
+        # Approximate entropy when no analytical form
+        entropy_loss = -th.mean(-log_prob)
+    else:
+        entropy_loss = -th.mean(entropy)
+
+    loss = policy_loss + ent_coef * entropy_loss + vf_coef * value_loss
+
+    with th.no_grad():
+        clip_fraction = th.mean((th.abs(ratio - 1) > clip_range).float())
+        # Calculate approximate form of reverse KL Divergence for early stopping
+        # see issue #417: https://github.com/DLR-RM/stable-baselines3/issues/417
+        # and discussion in PR #419: https://github.com/DLR-RM/stable-baselines3/pull/419
+        # and Schulman blog: http://joschu.net/blog/kl-approx.html
+        approx_kl_div = th.mean((ratio - 1) - log_ratio)
+
+    return (
+        loss,
+        policy_loss,
+        policy_loss_main_term.mean(),
+        value_loss,
+        entropy_loss,
+        anchor_policy_kl_div,
+        clip_fraction,
+        approx_kl_div,
+    )
+
+
+def _task_change_stats(
+    current_rewards: np.ndarray, prev_mean: float, prev_std: float, alpha: float
+) -> Tuple[float, bool]:
+    """
+    Mean of the current rewards, and whether it declined significantly compared
+    to the rewards of the previous training steps (JIT compiled when numba is installed).
+
+    :param current_rewards: Episode rewards of the current training step
+    :param prev_mean: Mean of the rewards of the previous training steps
+    :param prev_std: Standard deviation of the rewards of the previous training steps
+    :param alpha: Sensitivity parameter for task change detection
+    :return: mean of the current rewards and whether it is lower than
+        ``prev_mean - alpha * prev_std``
+    """
+    current_mean = current_rewards.mean()
+    return current_mean, current_mean < prev_mean - alpha * prev_std
+
+
+if njit is not None:
+    _task_change_stats = njit(cache=True)(_task_change_stats)
+
+
+def _sampled_kl_divs(
+    anchor_policy_log_probs: th.Tensor, curr_policy_log_probs: th.Tensor
+) -> th.Tensor:
+    """
+    Density-weighted estimate of the KL div with the anchor policy, from the
+    log-probabilities of the anchor actions. Inlined in ``_ppo_loss``.
+
+    :param anchor_policy_log_probs: Log-probs of the actions under the anchor policy
+    :param curr_policy_log_probs: Log-probs of the same actions under the current policy
+    :return: KL div estimate for each sample
+    """
+    return anchor_policy_log_probs.exp() * (
+        anchor_policy_log_probs - curr_policy_log_probs
+    )
+
+
+def _gaussian_kl_divs(
+    anchor_means: th.Tensor,
+    anchor_stds: th.Tensor,
+    curr_means: th.Tensor,
+    curr_stds: th.Tensor,
+) -> th.Tensor:
+    """
+    Closed form KL(anchor || current) between diagonal Gaussian policies.
+    Inlined in ``_ppo_loss``.
+
+    :param anchor_means: Means of the anchor policy distributions
+    :param anchor_stds: Standard deviations of the anchor policy distributions
+    :param curr_means: Means of the current policy distributions
+    :param curr_stds: Standard deviations of the current policy distributions
+    :return: KL div for each sample, summed over the action dimensions
+    """
+    var_ratio = (anchor_stds / curr_stds) ** 2
+    mean_term = ((anchor_means - curr_means) / curr_stds) ** 2
+    return 0.5 * (var_ratio + mean_term - 1 - var_ratio.log()).sum(dim=-1)
+
+
+def _bf16_latents(forward: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Wrap the forward method of a latent network so that it runs under BF16
+    autocast, and returns its latent features in FP32.
+
+    :param forward: Forward method returning a latent tensor or a tuple of them
+    :return: The wrapped forward method
+    """
+
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        with th.autocast(device_type="cuda", dtype=th.bfloat16):
+            latents = forward(*args, **kwargs)
+        if isinstance(latents, tuple):
+            return tuple(latent.float() for latent in latents)
+        return latents.float()
+
+    return wrapper
+
+
+def _explained_variance(y_pred: th.Tensor, y_true: th.Tensor) -> th.Tensor:
+    """
+    Device counterpart of ``stable_baselines3.common.utils.explained_variance``.
+
+    :param y_pred: the prediction
+    :param y_true: the expected value
+    :return: explained variance of ypred and y (nan if Var[y_true] is zero)
+    """
+    var_y = y_true.var(unbiased=False)
+    return th.where(
+        var_y == 0,
+        th.full_like(var_y, float("nan")),
+        1 - (y_true - y_pred).var(unbiased=False) / var_y,
+    )
+
+
+class DeviceRolloutBuffer(RolloutBuffer):
+    """
+    Rollout buffer that copies the whole rollout to the device once per update
+    and slices the minibatches directly out of the device tensors, instead of
+    converting every minibatch from numpy.
+
+    Takes the same parameters as ``RolloutBuffer``. The minibatch permutations are
+    drawn on the device, from ``generator`` when it is set.
+    """
+
+    generator: Optional[th.Generator] = None
+
+    def reset(self) -> None:
+        super().reset()
+        self._device_data: Optional[RolloutBufferSamples] = None
+
+    def get_device_data(self) -> RolloutBufferSamples:
+        """
+        Flatten the rollout and copy it to the device, on the first call
+        after the buffer has been filled.
+
+        :return: The whole rollout as device tensors
+        """
+        assert self.full, "The rollout buffer must be full before sampling from it"
+        if not self.generator_ready:
+            _tensor_names = [
+                "observations",
+                "actions",
+                "values",
+                "log_probs",
+                "advantages",
+                "returns",
+            ]
+            for tensor in _tensor_names:
+                self.__dict__[tensor] = self.swap_and_flatten(self.__dict__[tensor])
+            self.generator_ready = True
+
+        if self._device_data is None:
+            data = (
+                self.observations,
+                self.actions.astype(np.float32, copy=False),
+                self.values.flatten(),
+                self.log_probs.flatten(),
+                self.advantages.flatten(),
+                self.returns.flatten(),
+            )
+            self._device_data = RolloutBufferSamples(*tuple(map(self.to_torch, data)))
+        return self._device_data
+
+    def get(
+        self, batch_size: Optional[int] = None
+    ) -> Generator[RolloutBufferSamples, None, None]:
+        device_data = self.get_device_data()
+        n_samples = self.buffer_size * self.n_envs
+        # Return everything, don't create minibatches
+        if batch_size is None:
+            batch_size = n_samples
+
+        # One device permutation per pass, sliced into minibatch indices
+        indices = th.randperm(n_samples, device=self.device, generator=self.generator)
+        for batch_inds in th.split(indices, batch_size):
+            yield RolloutBufferSamples(
+                *(tensor[batch_inds] for tensor in device_data)
+            )
+
+
+class WindowedRunningStats:
+    """
+    Mean and standard deviation of the last ``window`` values pushed, updated in
+    O(1) with Welford's algorithm (and its inverse when a value leaves the window).
+    The values are kept in a preallocated numpy ring buffer.
+
+    :param window: Number of most recent values to keep
+    """
+
+    def __init__(self, window: int):
+        self.values = np.empty(window, dtype=np.float64)
+        self._pos = 0  # Next slot to write, holds the oldest value once full
+        self._count = 0
+        self.mean = 0.0
+        self._m2 = 0.0  # Sum of squared differences from the mean
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def std(self) -> float:
+        if self._count == 0:
+            return 0.0
+        return math.sqrt(self._m2 / self._count)
+
+    def push(self, value: float) -> None:
+        """
+        Add a value, evicting the oldest one if the window is full.
+
+        :param value: The new value
+        """
+        if self._count == len(self.values):
+            self._remove(float(self.values[self._pos]))
+        else:
+            self._count += 1
+        self.values[self._pos] = value
+        self._pos = (self._pos + 1) % len(self.values)
+
+        delta = value - self.mean
+        self.mean += delta / self._count
+        self._m2 += delta * (value - self.mean)
+
+    def _remove(self, value: float) -> None:
+        # Inverse Welford update, `value` is then overwritten by the new one
+        count = self._count - 1
+        if count == 0:
+            self.mean, self._m2 = 0.0, 0.0
+            return
+        delta = value - self.mean
+        self.mean -= delta / count
+        # Guard against rounding errors accumulated by the subtractive updates
+        self._m2 = max(self._m2 - delta * (value - self.mean), 0.0)
+
+
 class PolicyAnchoredPPO(OnPolicyAlgorithm):
     """
     Proximal Policy Optimization algorithm (PPO) (clip version)
@@ -41,6 +365,11 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
 
     Introduction to PPO: https://spinningup.openai.com/en/latest/algorithms/ppo.html
 
+    On CUDA devices, ``torch.set_float32_matmul_precision("high")`` is set when the model
+    is set up, which enables TF32 matmuls for the whole process. On Ampere or newer GPUs,
+    the hidden layers of the policy (``mlp_extractor``) also run under BF16 autocast,
+    while the action/value heads and the action distributions stay in FP32.
+
     :param policy: The policy model to use (MlpPolicy, CnnPolicy, ...)
     :param env: The environment to learn from (if registered in Gym, can be str)
     :param learning_rate: The learning rate, it can be a function
@@ -83,6 +412,18 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
     :param seed: Seed for the pseudo random generators
     :param device: Device (cpu, cuda, ...) on which the code should be run.
         Setting it to auto, the code will be run on the GPU if possible.
+    :param anchor_kl: How the KL div with the anchor policy is computed on the sampled states.
+        "sampled" (default) uses the density-weighted estimate ``E[p_a * (log p_a - log p_c)]``
+        over actions sampled from the anchor policy. "analytic" uses the closed form
+        KL(anchor || current), only for diagonal Gaussian policies (``Box`` action spaces).
+        The two terms differ by orders of magnitude, so ``anchor_pol_kl_coef`` must be tuned
+        separately for each.
+    :param compile_policy: Whether to compile the policy forward passes with ``torch.compile``
+        (only on CUDA devices). Disabled by default, as it makes debugging harder.
+    :param compile_loss: Whether to compile the minibatch loss with ``torch.compile``,
+        fusing its elementwise ops into a few kernels replayed with CUDA graphs.
+        Only used on CUDA devices with compute capability 7.0 or newer and Triton installed,
+        the loss runs eagerly otherwise. The first update pays the compilation time.
     :param _init_setup_model: Whether or not to build the network at the creation of the instance
     """
 
@@ -126,6 +467,9 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
         td_alpha: float = 0.5,
         _init_setup_model: bool = True,
         eps_length: int = 512,
+        compile_policy: bool = False,
+        compile_loss: bool = True,
+        anchor_kl: str = "sampled",
     ):
         super().__init__(
             policy,
@@ -187,18 +531,24 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
         self.clip_range_vf = clip_range_vf
         self.normalize_advantage = normalize_advantage
         self.target_kl = target_kl
+        self.compile_policy = compile_policy
+        self.compile_loss = compile_loss
         self.anchor_policy = None
         self.anchor_pol_sample_size = anchor_pol_sample_size
         self.anchor_pol_kl_coef = anchor_pol_kl_coef
+        assert anchor_kl in (
+            "sampled",
+            "analytic",
+        ), f"`anchor_kl` must be 'sampled' or 'analytic', got {anchor_kl!r}"
+        self.anchor_kl = anchor_kl
         self.gp_threshold = (
             gp_threshold  # Reward threshold to consider a policy as "good"
         )
         self.gp_k = gp_k  # Max number of good policies to store
         self.good_policies: List[
-            Tuple[ActorCriticPolicy, float]
-        ] = []  # List of (policy, reward)
+            Tuple[Dict[str, th.Tensor], float, int]
+        ] = []  # List of (policy state dict, reward, timestep)
         self.td_alpha = td_alpha  # Sensitivity parameter for task change detection
-        self.previous_rewards = []  # Buffer to store rewards of the previous training step
         self.td_counter = 0  # Counter to keep track of task changes
         self._ep_length = eps_length  # Length of the episode
         self._reward_grad_window = (
@@ -207,17 +557,30 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
         self.reward_grad_threshold = (
             -0.001
         )  # Threshold angle for the reward gradient (tan theta)
-        self.episodic_rewards = deque(
-            maxlen=self._reward_grad_window
-        )  # Buffer to store rewards of the previous training steps
+        self.episodic_rewards = WindowedRunningStats(
+            self._reward_grad_window
+        )  # Rewards of the previous training steps, with their mean and std
+        self._current_rewards = np.empty(
+            self._stats_window_size, dtype=np.float32
+        )  # Episode rewards of the current training step
         self.anchor_policy_timestep = (
             -1
         )  # Timestep at which the anchor policy was recorded
+        # Anchor policy outputs over the current rollout, see `_cache_anchor_outputs`
+        self._anchor_observations: Optional[th.Tensor] = None
+        self._anchor_actions: Optional[th.Tensor] = None
+        self._anchor_log_probs: Optional[th.Tensor] = None
+        self._anchor_means: Optional[th.Tensor] = None
+        self._anchor_stds: Optional[th.Tensor] = None
 
         if _init_setup_model:
             self._setup_model()
 
     def _setup_model(self) -> None:
+        if self.rollout_buffer_class is None and not isinstance(
+            self.observation_space, spaces.Dict
+        ):
+            self.rollout_buffer_class = DeviceRolloutBuffer
         super()._setup_model()
 
         # Initialize schedules for policy/value clipping
@@ -231,6 +594,73 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
 
             self.clip_range_vf = get_schedule_fn(self.clip_range_vf)
 
+        if self.anchor_kl == "analytic":
+            assert isinstance(self.policy.action_dist, DiagGaussianDistribution), (
+                "`anchor_kl='analytic'` requires a diagonal Gaussian policy, "
+                "use `anchor_kl='sampled'` for other action distributions"
+            )
+
+        if self.device.type == "cuda":
+            # Allow TF32 on the FP32 matmuls, note that this is a process-wide setting
+            th.set_float32_matmul_precision("high")
+            # BF16 only on Ampere or newer, older GPUs emulate it and run slower
+            if th.cuda.get_device_capability(self.device)[0] >= 8:
+                # Only the hidden layers run in BF16: the action/value heads and the
+                # distributions stay in FP32, for the rollout and training alike
+                mlp_extractor = self.policy.mlp_extractor
+                for name in ("forward", "forward_actor", "forward_critic"):
+                    forward = _bf16_latents(getattr(mlp_extractor, name))
+                    setattr(mlp_extractor, name, forward)
+
+        # Rebuild Adam with the fused CUDA kernel, the policy is only moved to
+        # the device after its optimizer has been created
+        if (
+            self.policy.optimizer_class is th.optim.Adam
+            and next(self.policy.parameters()).is_cuda
+        ):
+            self.policy.optimizer = th.optim.Adam(
+                self.policy.parameters(),
+                lr=self.lr_schedule(1),
+                **{**self.policy.optimizer_kwargs, "fused": True},
+            )
+
+        # Fuse the (small) policy networks with CUDA graphs, the minibatch shapes
+        # are fixed across updates
+        if self.compile_policy and self.device.type == "cuda":
+            self.policy.forward = th.compile(  # type: ignore[method-assign]
+                self.policy.forward, mode="reduce-overhead"
+            )
+            self.policy.evaluate_actions = th.compile(  # type: ignore[method-assign]
+                self.policy.evaluate_actions, mode="reduce-overhead"
+            )
+
+        # Fuse the minibatch loss with CUDA graphs, eager everywhere else
+        # (Inductor generates Triton kernels, which need Volta or newer)
+        self._ppo_loss = _ppo_loss
+        if (
+            self.compile_loss
+            and self.device.type == "cuda"
+            and th.cuda.get_device_capability(self.device)[0] >= 7
+            and importlib.util.find_spec("triton") is not None
+        ):
+            self._ppo_loss = th.compile(
+                _ppo_loss, mode="reduce-overhead", fullgraph=True
+            )
+
+        # Parameters passed to the grad norm clipping at every optimization step
+        self._param_list = list(self.policy.parameters())
+
+        # Device-resident generator, so that sampled indices are created on the device.
+        # Offset its seed from the global one (used for action sampling), so that both
+        # random streams stay independent
+        self._gen = th.Generator(device=self.device)
+        if self.seed is not None:
+            self._gen.manual_seed(self.seed + 1)
+        else:
+            self._gen.seed()
+        if isinstance(self.rollout_buffer, DeviceRolloutBuffer):
+            self.rollout_buffer.generator = self._gen
+
     def train(self) -> None:
         """
         Update policy using the currently gathered rollout buffer.
@@ -244,15 +674,52 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
         # Optional: clip range for the value function
         if self.clip_range_vf is not None:
             clip_range_vf = self.clip_range_vf(self._current_progress_remaining)  # type: ignore[operator]
+        # Pass the clip ranges to the compiled loss as tensors, so that schedules
+        # do not trigger a recompilation
+        clip_range_th = th.as_tensor(clip_range, device=self.device)
+        clip_range_vf_th = None
+        if self.clip_range_vf is not None:
+            clip_range_vf_th = th.as_tensor(clip_range_vf, device=self.device)
+        # Same for the loss coefficients, `anchor_pol_kl_coef` can be tuned during training
+        ent_coef_th = th.as_tensor(self.ent_coef, device=self.device)
+        vf_coef_th = th.as_tensor(self.vf_coef, device=self.device)
+        anchor_pol_kl_coef_th = th.as_tensor(
+            self.anchor_pol_kl_coef, device=self.device
+        )
+
+        # Accumulate the logged losses on the device, so that the GPU is only
+        # synchronized once at the end of the update
+        loss_sums = {
+            key: th.zeros((), device=self.device)
+            for key in (
+                "entropy_loss",
+                "policy_gradient_loss",
+                "value_loss",
+                "clip_fraction",
+            )
+        }
+        n_batches = 0
 
-        entropy_losses = []
-        pg_losses, value_losses = [], []
-        clip_fractions = []
+        # Normalize the advantages over the whole rollout once, instead of per minibatch
+        advantages = self.rollout_buffer.advantages
+        # Normalization does not make sense if buffer size == 1, see GH issue #325
+        if self.normalize_advantage and advantages.size > 1:
+            self.rollout_buffer.advantages = (advantages - advantages.mean()) / (
+                advantages.std(ddof=1) + 1e-8
+            )
+
+        # The anchor KL term is dead work without an anchor or with a zero coefficient
+        anchor_active = self.anchor_policy is not None and self.anchor_pol_kl_coef > 0
+        # The anchor policy is frozen between task changes, so its outputs over
+        # the rollout only need to be computed once per update
+        if anchor_active:
+            self._cache_anchor_outputs()
 
         continue_training = True
         # train for n_epochs epochs
         for epoch in range(self.n_epochs):
-            approx_kl_divs = []
+            approx_kl_sum = th.zeros((), device=self.device)
+            n_epoch_batches = 0
             # Do a complete pass on the rollout buffer
             for rollout_data in self.rollout_buffer.get(self.batch_size):
                 actions = rollout_data.actions
@@ -264,99 +731,86 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
                     rollout_data.observations, actions
                 )
                 values = values.flatten()
-                # Normalize advantage
-                advantages = rollout_data.advantages
-                # Normalization does not make sense if mini batchsize == 1, see GH issue #325
-                if self.normalize_advantage and len(advantages) > 1:
-                    advantages = (advantages - advantages.mean()) / (
-                        advantages.std() + 1e-8
-                    )
-
-                # ratio between old and new policy, should be one at the first iteration
-                ratio = th.exp(log_prob - rollout_data.old_log_prob)
 
                 # KL div with anchor
-                sampled_state_indices = th.randint(
-                    0,
-                    rollout_data.observations.shape[0],
-                    (self.anchor_pol_sample_size,),
-                )
-                sampled_states = rollout_data.observations[sampled_state_indices]
-                if self.anchor_policy is not None:
-                    _, _, anchor_policy_log_probs = self.anchor_policy(sampled_states)
-                    # anchor_policy_log_probs = th.log(anchor_policy_probs)
-
-                anchor_policy_kl_div = th.tensor(0.0, device=self.device)
-                if self.anchor_policy is not None:
-                    # print("using Anchor")
-                    _, _, curr_policy_log_probs = self.policy(sampled_states)
-                    # curr_policy_log_probs = th.log(curr_policy_probs)
-                    anchor_policy_probs = th.exp(anchor_policy_log_probs)
-                    anchor_policy_kl_div = th.mean(
-                        anchor_policy_probs
-                        * (anchor_policy_log_probs - curr_policy_log_probs)
+                anchor_kl_divs_fn, anchor_kl_inputs = None, ()
+                if anchor_active:
+                    sampled_state_indices = th.randint(
+                        0,
+                        self._anchor_observations.shape[0],
+                        (self.anchor_pol_sample_size,),
+                        device=self.device,
+                        generator=self._gen,
                     )
+                    sampled_states = self._anchor_observations[sampled_state_indices]
+                    if self.anchor_kl == "analytic":
+                        # Closed form, no need to sample anchor actions
+                        curr_distribution = self.policy.get_distribution(
+                            sampled_states
+                        ).distribution
+                        anchor_kl_divs_fn = _gaussian_kl_divs
+                        anchor_kl_inputs = (
+                            self._anchor_means[sampled_state_indices],
+                            self._anchor_stds[sampled_state_indices],
+                            curr_distribution.mean,
+                            curr_distribution.stddev,
+                        )
+                    else:
+                        # Log-probs of the anchor actions under the current policy
+                        _, curr_policy_log_probs, _ = self.policy.evaluate_actions(
+                            sampled_states,
+                            self._anchor_actions[sampled_state_indices],
+                        )
+                        anchor_kl_divs_fn = _sampled_kl_divs
+                        anchor_kl_inputs = (
+                            self._anchor_log_probs[sampled_state_indices],
+                            curr_policy_log_probs,
+                        )
 
-                # clipped surrogate loss
-                policy_loss_1 = advantages * ratio
-                policy_loss_2 = advantages * th.clamp(
-                    ratio, 1 - clip_range, 1 + clip_range
+                (
+                    loss,
+                    policy_loss,
+                    policy_loss_main_term,
+                    value_loss,
+                    entropy_loss,
+                    anchor_policy_kl_div,
+                    clip_fraction,
+                    approx_kl_div,
+                ) = self._ppo_loss(
+                    log_prob,
+                    rollout_data.old_log_prob,
+                    rollout_data.advantages,
+                    values,
+                    rollout_data.old_values,
+                    rollout_data.returns,
+                    entropy,
+                    anchor_kl_divs_fn,
+                    anchor_kl_inputs,
+                    clip_range_th,
+                    clip_range_vf_th,
+                    ent_coef_th,
+                    vf_coef_th,
+                    anchor_pol_kl_coef_th,
                 )
-                policy_loss = (
-                    -th.min(policy_loss_1, policy_loss_2)
-                    + self.anchor_pol_kl_coef * anchor_policy_kl_div
-                )
-                policy_loss = policy_loss.mean()
 
                 # Logging
-                pg_losses.append(policy_loss.item())
-                clip_fraction = th.mean((th.abs(ratio - 1) > clip_range).float()).item()
-                clip_fractions.append(clip_fraction)
-
-                if self.clip_range_vf is None:
-                    # No clipping
-                    values_pred = values
-                else:
-                    # Clip the difference between old and new value
-                    # NOTE: this depends on the reward scaling
-                    values_pred = rollout_data.old_values + th.clamp(
-                        values - rollout_data.old_values, -clip_range_vf, clip_range_vf
-                    )
-                # Value loss using the TD(gae_lambda) target
-                value_loss = F.mse_loss(rollout_data.returns, values_pred)
-                value_losses.append(value_loss.item())
-
-                # Entropy loss favor exploration
-                if entropy is None:
-                    # Approximate entropy when no analytical form
-                    entropy_loss = -th.mean(-log_prob)
-                else:
-                    entropy_loss = -th.mean(entropy)
-
-                entropy_losses.append(entropy_loss.item())
-
-                # Calculate approximate form of reverse KL Divergence for early stopping
-                # see issue #417: https://github.com/DLR-RM/stable-baselines3/issues/417
-                # and discussion in PR #419: https://github.com/DLR-RM/stable-baselines3/pull/419
-                # and Schulman blog: http://joschu.net/blog/kl-approx.html
-                with th.no_grad():
-                    log_ratio = log_prob - rollout_data.old_log_prob
-                    approx_kl_div = (
-                        th.mean((th.exp(log_ratio) - 1) - log_ratio).cpu().numpy()
-                    )
-                    approx_kl_divs.append(approx_kl_div)
-
-                loss = (
-                    policy_loss
-                    + self.ent_coef * entropy_loss
-                    + self.vf_coef * value_loss
-                )
+                loss_sums["entropy_loss"] += entropy_loss.detach()
+                loss_sums["policy_gradient_loss"] += policy_loss.detach()
+                loss_sums["value_loss"] += value_loss.detach()
+                loss_sums["clip_fraction"] += clip_fraction
+                n_batches += 1
+                approx_kl_sum += approx_kl_div
+                n_epoch_batches += 1
 
-                if self.target_kl is not None and approx_kl_div > 1.5 * self.target_kl:
+                # Only sync with the device when early stopping is enabled
+                if (
+                    self.target_kl is not None
+                    and (approx_kl_div > 1.5 * self.target_kl).item()
+                ):
                     continue_training = False
                     if self.verbose >= 1:
                         print(
-                            f"Early stopping at step {epoch} due to reaching max kl: {approx_kl_div:.2f}"
+                            f"Early stopping at step {epoch} due to reaching max kl: {approx_kl_div.item():.2f}"
                         )
                     break
 
@@ -365,7 +819,7 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
                 loss.backward()
                 # Clip grad norm
                 th.nn.utils.clip_grad_norm_(
-                    self.policy.parameters(), self.max_grad_norm
+                    self._param_list, self.max_grad_norm, foreach=True
                 )
                 self.policy.optimizer.step()
 
@@ -373,41 +827,50 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
             if not continue_training:
                 break
 
-        explained_var = explained_variance(
-            self.rollout_buffer.values.flatten(), self.rollout_buffer.returns.flatten()
-        )
+        if isinstance(self.rollout_buffer, DeviceRolloutBuffer):
+            rollout_data = self.rollout_buffer.get_device_data()
+            values, returns = rollout_data.old_values, rollout_data.returns
+        else:
+            values = self.rollout_buffer.to_torch(self.rollout_buffer.values.flatten())
+            returns = self.rollout_buffer.to_torch(
+                self.rollout_buffer.returns.flatten()
+            )
+        explained_var = _explained_variance(values, returns)
 
         # task change detection starts ...
         if len(self.ep_info_buffer) != 0:
-            current_rewards = [ep_info["r"] for ep_info in self.ep_info_buffer]
-            accumulated_rewards = np.mean(current_rewards)
+            # Reuse the preallocated buffer, `ep_info_buffer` is bounded by its size
+            current_rewards = self._current_rewards[: len(self.ep_info_buffer)]
+            for idx, ep_info in enumerate(self.ep_info_buffer):
+                current_rewards[idx] = ep_info["r"]
+            accumulated_rewards = float(current_rewards.mean())
 
-            self.episodic_rewards.append(accumulated_rewards)
             self.detect_task_change(current_rewards)
-
-            self.previous_rewards = current_rewards
+            self.episodic_rewards.push(accumulated_rewards)
 
             self.update_good_policies(self.policy, accumulated_rewards)
         # task change detection ends ...
 
         # Logs
-        self.logger.record("train/entropy_loss", np.mean(entropy_losses))
-        self.logger.record("train/policy_gradient_loss", np.mean(pg_losses))
-        self.logger.record("train/value_loss", np.mean(value_losses))
-        self.logger.record("train/approx_kl", np.mean(approx_kl_divs))
-        self.logger.record("train/clip_fraction", np.mean(clip_fractions))
-        self.logger.record("train/loss", loss.item())
-        self.logger.record("train/explained_variance", explained_var)
-        self.logger.record("train/policy_loss", policy_loss.item())
-        self.logger.record(
-            "train/policy_loss_main_term",
-            -th.min(policy_loss_1, policy_loss_2).mean().item(),
-        )
-        self.logger.record(
-            "train/policy_loss_div_term",
-            (self.anchor_pol_kl_coef * anchor_policy_kl_div).item(),
-        )
-        self.logger.record("train/anchor_kl_div", anchor_policy_kl_div.item())
+        logged_values = {
+            "train/entropy_loss": loss_sums["entropy_loss"] / n_batches,
+            "train/policy_gradient_loss": loss_sums["policy_gradient_loss"]
+            / n_batches,
+            "train/value_loss": loss_sums["value_loss"] / n_batches,
+            "train/approx_kl": approx_kl_sum / n_epoch_batches,
+            "train/clip_fraction": loss_sums["clip_fraction"] / n_batches,
+            "train/loss": loss,
+            "train/policy_loss": policy_loss,
+            "train/policy_loss_main_term": policy_loss_main_term,
+            "train/policy_loss_div_term": self.anchor_pol_kl_coef
+            * anchor_policy_kl_div,
+            "train/anchor_kl_div": anchor_policy_kl_div,
+            "train/explained_variance": explained_var,
+        }
+        # Single device -> host transfer for all the logged values
+        host_values = th.stack(list(logged_values.values())).detach().cpu()
+        for key, value in zip(logged_values, host_values.tolist()):
+            self.logger.record(key, value)
         if hasattr(self.policy, "log_std"):
             self.logger.record("train/std", th.exp(self.policy.log_std).mean().item())
 
@@ -416,6 +879,58 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
         if self.clip_range_vf is not None:
             self.logger.record("train/clip_range_vf", clip_range_vf)
 
+    def _cache_anchor_outputs(self, chunk_size: int = 4096) -> None:
+        """
+        Run the anchor policy once over every observation of the rollout and store
+        its outputs on the device: the means and standard deviations of its action
+        distributions for the "analytic" ``anchor_kl``, otherwise sampled actions
+        along with their log-probabilities.
+
+        :param chunk_size: Number of observations per anchor forward pass
+        """
+        if isinstance(self.rollout_buffer, DeviceRolloutBuffer):
+            observations = self.rollout_buffer.get_device_data().observations
+        else:
+            observations = self.rollout_buffer.observations
+            if not self.rollout_buffer.generator_ready:
+                observations = self.rollout_buffer.swap_and_flatten(observations)
+            observations = self.rollout_buffer.to_torch(observations)
+
+        analytic = self.anchor_kl == "analytic"
+        outputs: Tuple[List[th.Tensor], List[th.Tensor]] = ([], [])
+        with th.no_grad():
+            for start_idx in range(0, observations.shape[0], chunk_size):
+                chunk = observations[start_idx : start_idx + chunk_size]
+                if analytic:
+                    distribution = self.anchor_policy.get_distribution(chunk)
+                    outputs[0].append(distribution.distribution.mean)
+                    outputs[1].append(distribution.distribution.stddev)
+                else:
+                    chunk_actions, _, chunk_log_probs = self.anchor_policy(chunk)
+                    outputs[0].append(chunk_actions)
+                    outputs[1].append(chunk_log_probs)
+
+        self._anchor_observations = observations
+        self._anchor_means, self._anchor_stds = None, None
+        self._anchor_actions, self._anchor_log_probs = None, None
+        if analytic:
+            self._anchor_means, self._anchor_stds = map(th.cat, outputs)
+        else:
+            self._anchor_actions, self._anchor_log_probs = map(th.cat, outputs)
+
+    def _excluded_save_params(self) -> List[str]:
+        # Runtime caches, rebuilt by `_setup_model` and `train`
+        return super()._excluded_save_params() + [
+            "_gen",
+            "_param_list",
+            "_ppo_loss",
+            "_anchor_observations",
+            "_anchor_actions",
+            "_anchor_log_probs",
+            "_anchor_means",
+            "_anchor_stds",
+        ]
+
     def learn(
         self: SelfPPO,
         total_timesteps: int,
@@ -442,30 +957,38 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
         """
         if reward >= self.gp_threshold or task_change:
             print("Saving good Policy...")
-            self.good_policies.append((policy, reward, self.num_timesteps))
+            # Snapshot the parameters on the CPU, the policy object itself keeps
+            # training after this call
+            state_dict = {
+                key: value.detach().to("cpu", copy=True)
+                for key, value in policy.state_dict().items()
+            }
+            self.good_policies.append((state_dict, reward, self.num_timesteps))
 
-            # Sort based on rewards in descending order and keep only top k policies
-            self.good_policies.sort(key=lambda x: x[2], reverse=True)
-            self.good_policies = self.good_policies[: self.gp_k]
+            # Keep only the top k policies, in descending order of rewards
+            self.good_policies = heapq.nlargest(
+                self.gp_k, self.good_policies, key=lambda x: x[1]
+            )
 
-    def detect_task_change(self, current_rewards: List[float]):
+    def detect_task_change(self, current_rewards: np.ndarray):
         """
         Detect if the task/environment has changed based on reward decline.
         A task change is detected if the current rewards are significantly lower
-        than the mean of the previous rewards (by alpha times standard deviation).
+        than the mean of the rewards of the previous training steps
+        (by alpha times standard deviation).
         """
-        if len(self.previous_rewards) == 0:
+        if len(self.episodic_rewards) == 0:
             # No previous rewards available to compare, skip detection
             return
 
-        # Calculate mean and standard deviation of previous rewards
-        prev_mean = np.mean(self.previous_rewards)
-        prev_std = np.std(self.previous_rewards)
-
-        # Calculate mean of current rewards
-        current_mean = np.mean(current_rewards)
+        # Mean and standard deviation of previous rewards, maintained incrementally
+        prev_mean = self.episodic_rewards.mean
+        prev_std = self.episodic_rewards.std
 
         # Check if there's a sharp decline (current rewards < prev_mean - alpha * prev_std)
+        current_mean, reward_declined = _task_change_stats(
+            current_rewards, prev_mean, prev_std, self.td_alpha
+        )
         if self.num_timesteps // 1e6 != (self.num_timesteps - self.n_steps) // 1e6:
             print(f"self.num_timesteps // 1e6:  {self.num_timesteps // 1e6}")
             print(f"self._ep_length:  {self._ep_length}")
@@ -475,15 +998,37 @@ class PolicyAnchoredPPO(OnPolicyAlgorithm):
             )
             # print("self.num_timesteps: ", self.num_timesteps)
             print(
-                f"Task change detected! Current rewards: {current_mean:.2f}, Previous mean: {prev_mean:.2f}, Std: {prev_std:.2f}"
+                f"Task change detected! Current rewards: {current_mean:.2f}, Previous mean: {prev_mean:.2f}, Std: {prev_std:.2f}, Reward declined: {reward_declined}"
             )
             self.td_counter += 1
-            self.anchor_policy = self.good_policies[0][0]
+            if self.anchor_policy is None:
+                self.anchor_policy = self._make_anchor_policy()
+            # Materialize the CPU snapshot on the device, in place
+            self.anchor_policy.load_state_dict(self.good_policies[0][0])
             # print("Policy Taken: ", self.good_policies[0][2])
             self.anchor_policy_timestep = self.good_policies[0][2]
 
+    def _make_anchor_policy(self) -> ActorCriticPolicy:
+        """
+        Build the anchor policy, with the same architecture as the current policy.
+        It is created once, the good policy snapshots are then loaded into it.
+        """
+        anchor_policy = self.policy_class(  # type: ignore[assignment]
+            self.observation_space,
+            self.action_space,
+            self.lr_schedule,
+            use_sde=self.use_sde,
+            **self.policy_kwargs,
+        )
+        anchor_policy = anchor_policy.to(self.device)
+        # The anchor is never updated, freeze it so that no autograd graph is built
+        anchor_policy.set_training_mode(False)
+        anchor_policy.requires_grad_(False)
+        return anchor_policy
+
     def get_good_policies(self):
         """
-        Get the current list of good policies and their associated rewards.
+        Get the current list of good policies (as CPU state dicts) and their
+        associated rewards and timesteps.
         """
         return self.good_policies